@@ -0,0 +1,170 @@
+"""Multi-worker load test for the /send_email path.
+
+Starts `uvicorn loadtest:app --workers N` for N = 1..--max-workers against a
+temporary SQLite token store, with the Gmail API replaced by a stub that
+blocks for --gmail-latency seconds (send_email calls Gmail synchronously, so
+each worker handles one send at a time). Prints requests per second for each
+worker count; with enough clients it should grow close to linearly.
+
+    python backend/loadtest.py --max-workers 4 --duration 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+import main
+
+USER_EMAIL = "loadtest@example.com"
+
+
+class _StubGmail:
+    """Just enough of the Gmail client for send_email."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        return self
+
+    def execute(self):
+        time.sleep(self.latency)
+        return {"id": "stub"}
+
+
+# Imported by each uvicorn worker: the real app with Gmail stubbed out
+main.build = lambda *args, **kwargs: _StubGmail(float(os.getenv("LOADTEST_GMAIL_LATENCY", "0.02")))
+app = main.app
+
+
+def _seed_token(db_path):
+    store = main.SQLiteTokenStore(db_path)
+    store.save(USER_EMAIL, json.dumps({
+        "token": "access",
+        "refresh_token": "refresh",
+        "client_id": "client",
+        "client_secret": "secret",
+        "expiry": (datetime.utcnow() + timedelta(hours=1)).isoformat() + "Z",
+    }))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/get_authenticated_user")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"uvicorn did not start on port {port}")
+
+
+def _client(port, deadline, results):
+    body = urllib.parse.urlencode({
+        "user_email": USER_EMAIL,
+        "recipient": "someone@example.com",
+        "subject": "load test",
+        "body": "hello",
+    })
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    ok = failed = 0
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.time() < deadline:
+        try:
+            conn.request("POST", "/send_email", body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                ok += 1
+            else:
+                failed += 1
+        except OSError:
+            failed += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.close()
+    results.put((ok, failed))
+
+
+def run(workers, clients, duration, gmail_latency, db_path):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        TOKEN_STORE_URL=f"sqlite:///{db_path}",
+        LOADTEST_GMAIL_LATENCY=str(gmail_latency),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "loadtest:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        _wait_until_ready(port)
+        results = multiprocessing.Queue()
+        deadline = time.time() + duration
+        procs = [
+            multiprocessing.Process(target=_client, args=(port, deadline, results))
+            for _ in range(clients)
+        ]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    ok = sum(t[0] for t in totals)
+    failed = sum(t[1] for t in totals)
+    return ok / duration, failed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--clients-per-worker", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.sqlite")
+        _seed_token(db_path)
+
+        baseline = None
+        print(f"{'workers':>7} {'req/s':>9} {'speedup':>8} {'failed':>7}")
+        for workers in range(1, args.max_workers + 1):
+            rps, failed = run(workers, workers * args.clients_per_worker,
+                              args.duration, args.gmail_latency, db_path)
+            baseline = baseline or rps
+            print(f"{workers:>7} {rps:>9.1f} {rps / baseline:>7.2f}x {failed:>7}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -5,9 +5,15 @@ from pydantic import BaseModel
 import sqlite3
 import os
 import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
 
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from googleapiclient.discovery import build
 import base64
 from email.mime.text import MIMEText
@@ -15,29 +21,383 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 
-app = FastAPI()
-
 DB_PATH = os.path.join(os.getcwd(), "backend", "db.sqlite")
 print(f"SQLite DB path: {DB_PATH}")
 
-os.makedirs("backend", exist_ok=True)
-print(f"DB directory 'backend' exists or created.")
+# Set TOKEN_STORE_URL=redis://host:6379/0 to share tokens between workers/instances
+# (needs the optional `redis` package). sqlite:////path/to/db.sqlite picks another
+# SQLite file; left unset, tokens stay in DB_PATH (fine for a single host).
+TOKEN_STORE_URL = os.getenv("TOKEN_STORE_URL", "")
+INVALIDATION_CHANNEL = "emmy:token-invalidate"
+
+# Cached credentials are dropped after this many seconds even if an invalidation
+# event never arrives, so a missed event can't keep a logged-out user usable forever.
+CREDENTIALS_CACHE_TTL = float(os.getenv("CREDENTIALS_CACHE_TTL", "60"))
+
+# How long one worker may hold the refresh lock before others can take it over.
+REFRESH_LOCK_TTL = 30
+
+
+# Token store interface: every implementation keeps email -> token JSON plus a
+# per-email generation counter that is bumped on every change, and tells the
+# other workers when a token changes so they can drop cached credentials.
+class TokenStore(ABC):
+    def __init__(self):
+        # Lets a worker skip the invalidation events it published itself
+        self.instance_id = uuid.uuid4().hex
+
+    @abstractmethod
+    def get(self, email: str):
+        """Return (token_json, generation); token_json is None if the user is logged out."""
+
+    @abstractmethod
+    def generation(self, email: str) -> int:
+        """Return the current generation for email (0 if it never had a token)."""
+
+    @abstractmethod
+    def save(self, email: str, token_json: str) -> int:
+        """Store the token, bump the generation and return the new generation."""
+
+    @abstractmethod
+    def delete(self, email: str) -> int:
+        """Remove the token, bump the generation and return the new generation."""
+
+    @abstractmethod
+    def first_email(self):
+        """Return any stored email; which one is unspecified if several users are logged in."""
+
+    @abstractmethod
+    def acquire_refresh_lock(self, email: str, ttl: float):
+        """Try to take the token refresh lock for email; return an owner id or None."""
+
+    @abstractmethod
+    def release_refresh_lock(self, email: str, owner: str):
+        """Release a lock taken by acquire_refresh_lock, if it is still ours."""
+
+    @abstractmethod
+    def publish_invalidation(self, email: str):
+        """Tell the other workers to drop their cached credentials for email."""
+
+    @abstractmethod
+    def listen_invalidations(self, on_invalidate, on_reset):
+        """Start a daemon thread calling on_invalidate(email) for every event from
+        another worker, and on_reset() whenever events may have been missed."""
+
+    @abstractmethod
+    def close(self):
+        """Stop the invalidation listener."""
+
+
+class SQLiteTokenStore(TokenStore):
+    def __init__(self, db_path: str, poll_interval: float = 1.0):
+        super().__init__()
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        print(f"DB exists before creation? {os.path.exists(db_path)}")
+        conn = sqlite3.connect(db_path, timeout=10)
+        print("Connected to SQLite DB")
+        try:
+            # WAL lets several worker processes read while one writes; the mode
+            # is stored in the database file, so setting it once is enough
+            conn.execute("PRAGMA journal_mode=WAL")
+            cursor = conn.cursor()
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                email TEXT PRIMARY KEY,
+                token TEXT
+            )
+            """)
+            # Kept across logouts so a generation never goes backwards
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS token_generations (
+                email TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL
+            )
+            """)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS refresh_locks (
+                email TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """)
+            # Append-only log the workers on this host poll to evict stale cache entries
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS token_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT,
+                origin TEXT
+            )
+            """)
+            conn.commit()
+            print("Created tokens table if not existing")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _bump_generation(self, conn, email: str) -> int:
+        conn.execute("""
+        INSERT INTO token_generations (email, generation) VALUES (?, 1)
+        ON CONFLICT(email) DO UPDATE SET generation = generation + 1
+        """, (email,))
+        return conn.execute(
+            "SELECT generation FROM token_generations WHERE email=?", (email,)
+        ).fetchone()[0]
+
+    def get(self, email: str):
+        conn = self._connect()
+        try:
+            row = conn.execute("""
+            SELECT t.token, g.generation FROM token_generations g
+            LEFT JOIN tokens t ON t.email = g.email
+            WHERE g.email=?
+            """, (email,)).fetchone()
+            if row is None:
+                # Token saved by an older version that had no generation table
+                row = conn.execute("SELECT token, 0 FROM tokens WHERE email=?", (email,)).fetchone()
+        finally:
+            conn.close()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def generation(self, email: str) -> int:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT generation FROM token_generations WHERE email=?", (email,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def save(self, email: str, token_json: str) -> int:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("REPLACE INTO tokens (email, token) VALUES (?, ?)", (email, token_json))
+                return self._bump_generation(conn, email)
+        finally:
+            conn.close()
+
+    def delete(self, email: str) -> int:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM tokens WHERE email=?", (email,))
+                return self._bump_generation(conn, email)
+        finally:
+            conn.close()
+
+    def first_email(self):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT email FROM tokens LIMIT 1").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def acquire_refresh_lock(self, email: str, ttl: float):
+        owner = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM refresh_locks WHERE email=? AND expires_at < ?", (email, now))
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO refresh_locks (email, owner, expires_at) VALUES (?, ?, ?)",
+                    (email, owner, now + ttl),
+                )
+        finally:
+            conn.close()
+        return owner if cursor.rowcount == 1 else None
+
+    def release_refresh_lock(self, email: str, owner: str):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM refresh_locks WHERE email=? AND owner=?", (email, owner))
+        finally:
+            conn.close()
+
+    def publish_invalidation(self, email: str):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO token_events (email, origin) VALUES (?, ?)", (email, self.instance_id)
+                )
+                # Keep the log short; workers only need events newer than their last poll
+                conn.execute("DELETE FROM token_events WHERE id <= (SELECT MAX(id) FROM token_events) - 1000")
+        finally:
+            conn.close()
+
+    def listen_invalidations(self, on_invalidate, on_reset):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT MAX(id) FROM token_events").fetchone()
+        finally:
+            conn.close()
+        last_id = row[0] or 0
+
+        def poll():
+            nonlocal last_id
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    conn = self._connect()
+                    try:
+                        rows = conn.execute(
+                            "SELECT id, email, origin FROM token_events WHERE id > ? ORDER BY id", (last_id,)
+                        ).fetchall()
+                    finally:
+                        conn.close()
+                except sqlite3.Error as e:
+                    print(f"Token invalidation poll failed: {e}")
+                    continue
+                if rows and rows[0][0] > last_id + 1 and last_id:
+                    # The log was trimmed past our position, so some events are gone
+                    on_reset()
+                for event_id, email, origin in rows:
+                    last_id = event_id
+                    if origin != self.instance_id:
+                        on_invalidate(email)
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def close(self):
+        self._stop.set()
+
+
+class RedisTokenStore(TokenStore):
+    TOKENS_KEY = "emmy:tokens"
+    GENERATIONS_KEY = "emmy:token-generations"
+    REFRESH_LOCK_PREFIX = "emmy:refresh-lock:"
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self._listener = None
+
+    def get(self, email: str):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hget(self.TOKENS_KEY, email)
+        pipe.hget(self.GENERATIONS_KEY, email)
+        token_json, generation = pipe.execute()
+        return token_json, int(generation or 0)
+
+    def generation(self, email: str) -> int:
+        return int(self.client.hget(self.GENERATIONS_KEY, email) or 0)
+
+    def save(self, email: str, token_json: str) -> int:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self.TOKENS_KEY, email, token_json)
+        pipe.hincrby(self.GENERATIONS_KEY, email, 1)
+        return pipe.execute()[1]
+
+    def delete(self, email: str) -> int:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hdel(self.TOKENS_KEY, email)
+        pipe.hincrby(self.GENERATIONS_KEY, email, 1)
+        return pipe.execute()[1]
+
+    def first_email(self):
+        # Hash order is arbitrary, so this may not be the same user SQLite would return
+        for email, _ in self.client.hscan_iter(self.TOKENS_KEY, count=10):
+            return email
+        return None
 
-print(f"DB exists before creation? {os.path.exists(DB_PATH)}")
+    def acquire_refresh_lock(self, email: str, ttl: float):
+        owner = uuid.uuid4().hex
+        if self.client.set(self.REFRESH_LOCK_PREFIX + email, owner, nx=True, px=int(ttl * 1000)):
+            return owner
+        return None
 
-conn = sqlite3.connect(DB_PATH)
-print("Connected to SQLite DB")
+    def release_refresh_lock(self, email: str, owner: str):
+        key = self.REFRESH_LOCK_PREFIX + email
 
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS tokens (
-    email TEXT PRIMARY KEY,
-    token TEXT
-)
-""")
-conn.commit()
-print("Created tokens table if not existing")
-conn.close()
+        # Only delete the lock if it is still ours (it may have expired and been retaken)
+        def delete_if_owner(pipe):
+            if pipe.get(key) == owner:
+                pipe.multi()
+                pipe.delete(key)
+
+        self.client.transaction(delete_if_owner, key)
+
+    def publish_invalidation(self, email: str):
+        self.client.publish(INVALIDATION_CHANNEL, json.dumps({"email": email, "origin": self.instance_id}))
+
+    def listen_invalidations(self, on_invalidate, on_reset):
+        def handle_message(message):
+            event = json.loads(message["data"])
+            if event["origin"] != self.instance_id:
+                on_invalidate(event["email"])
+
+        def handle_error(error, pubsub, thread):
+            # The next get_message() reconnects and resubscribes, but anything
+            # published while we were disconnected is lost, so start from scratch
+            print(f"Token invalidation channel error, flushing credentials cache: {error}")
+            on_reset()
+            time.sleep(1)
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: handle_message})
+        self._listener = pubsub.run_in_thread(sleep_time=0.5, daemon=True, exception_handler=handle_error)
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+def create_token_store(url: str) -> TokenStore:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis  # Optional dependency, only needed for the Redis store
+
+        print(f"Using Redis token store at {url}")
+        return RedisTokenStore(redis.Redis.from_url(url, decode_responses=True))
+    if url.startswith("sqlite:///"):
+        return SQLiteTokenStore(url[len("sqlite:///"):])
+    if url:
+        raise RuntimeError(f"Unsupported TOKEN_STORE_URL: {url}")
+    return SQLiteTokenStore(DB_PATH)
+
+
+# Set up by the lifespan handler so importing this module doesn't open connections
+token_store = None
+
+# Per-worker cache of email -> (Credentials, generation, cached_at). Entries are
+# evicted by the invalidation channel and expire after CREDENTIALS_CACHE_TTL.
+_credentials_cache = {}
+_credentials_cache_lock = threading.Lock()
+
+
+def evict_cached_credentials(email: str):
+    with _credentials_cache_lock:
+        _credentials_cache.pop(email, None)
+
+
+def clear_credentials_cache():
+    with _credentials_cache_lock:
+        _credentials_cache.clear()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global token_store
+    token_store = create_token_store(TOKEN_STORE_URL)
+    token_store.listen_invalidations(evict_cached_credentials, clear_credentials_cache)
+    try:
+        yield
+    finally:
+        token_store.close()
+        token_store = None
+        clear_credentials_cache()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow frontend requests (Update with your actual Streamlit frontend URL, no trailing slash)
 app.add_middleware(
@@ -83,11 +443,9 @@ def oauth2callback(request: Request):
 
         token_json = creds.to_json()
 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("REPLACE INTO tokens (email, token) VALUES (?, ?)", (email, token_json))
-        conn.commit()
-        conn.close()
+        token_store.save(email, token_json)
+        evict_cached_credentials(email)
+        token_store.publish_invalidation(email)
 
         return JSONResponse({"message": "Authentication successful!", "email": email})
     except Exception as e:
@@ -96,33 +454,73 @@ def oauth2callback(request: Request):
 # Endpoint to get authenticated user email for frontend
 @app.get("/get_authenticated_user")
 def get_authenticated_user():
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT email FROM tokens LIMIT 1")
-        row = cursor.fetchone()
-    finally:
-        conn.close()
+    email = token_store.first_email()
 
-    if not row:
+    if not email:
         return JSONResponse({"email": None}, status_code=404)
-    return {"email": row[0]}
+    return {"email": email}
+
+def _load_credentials(token_json: str):
+    return Credentials.from_authorized_user_info(json.loads(token_json), SCOPES)
+
+# Refresh an expired token under the per-email refresh lock so only one worker
+# talks to Google; the others wait and pick up the token it saved.
+def _refresh_credentials(user_email: str):
+    while True:
+        token_json, generation = token_store.get(user_email)
+        if not token_json:
+            return None, generation
+        creds = _load_credentials(token_json)
+        if not creds.expired:
+            return creds, generation
+        owner = token_store.acquire_refresh_lock(user_email, REFRESH_LOCK_TTL)
+        if owner:
+            break
+        time.sleep(0.1)
 
-# Helper function to get Credentials object from DB JSON
-def get_credentials(user_email: str):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT token FROM tokens WHERE email=?", (user_email,))
-        row = cursor.fetchone()
+        # Re-read under the lock: the previous holder may have just saved a fresh token
+        token_json, generation = token_store.get(user_email)
+        if not token_json:
+            return None, generation
+        creds = _load_credentials(token_json)
+        if creds.expired and creds.refresh_token:
+            creds.refresh(GoogleAuthRequest())
+            generation = token_store.save(user_email, creds.to_json())
+            token_store.publish_invalidation(user_email)
+        return creds, generation
     finally:
-        conn.close()
+        token_store.release_refresh_lock(user_email, owner)
 
-    if not row:
+# Helper function to get Credentials object from the token store, cached per worker
+def get_credentials(user_email: str):
+    with _credentials_cache_lock:
+        entry = _credentials_cache.get(user_email)
+    if entry is not None:
+        creds, generation, cached_at = entry
+        if time.monotonic() - cached_at < CREDENTIALS_CACHE_TTL and not creds.expired:
+            return creds
+
+    token_json, generation = token_store.get(user_email)
+    if not token_json:
+        evict_cached_credentials(user_email)
         return None
 
-    token_info = json.loads(row[0])
-    creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+    creds = _load_credentials(token_json)
+    if creds.expired and creds.refresh_token:
+        creds, generation = _refresh_credentials(user_email)
+        if creds is None:
+            evict_cached_credentials(user_email)
+            return None
+
+    # Only cache if nothing changed since our read. The check runs under the cache
+    # lock, so an invalidation either bumps the generation before it (and we skip
+    # caching) or its eviction waits for us and removes the entry afterwards.
+    with _credentials_cache_lock:
+        if token_store.generation(user_email) == generation:
+            _credentials_cache[user_email] = (creds, generation, time.monotonic())
+        else:
+            _credentials_cache.pop(user_email, None)
     return creds
 
 # Email sending endpoint with file attachment support
@@ -171,11 +569,9 @@ async def send_email(
 @app.post("/logout")
 async def logout(user_email: str = Form(...)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM tokens WHERE email=?", (user_email,))
-        conn.commit()
-        conn.close()
+        token_store.delete(user_email)
+        evict_cached_credentials(user_email)
+        token_store.publish_invalidation(user_email)
         return {"message": f"User {user_email} logged out successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Logout failed: {e}")
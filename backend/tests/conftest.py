@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py lives in backend/ and is run as a plain module by uvicorn
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
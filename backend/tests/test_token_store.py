@@ -0,0 +1,239 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+from google.oauth2.credentials import Credentials
+
+import main
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def make_token(token="access", expires_in=3600):
+    expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+    return json.dumps({
+        "token": token,
+        "refresh_token": "refresh",
+        "client_id": "client",
+        "client_secret": "secret",
+        "expiry": expiry.isoformat() + "Z",
+    })
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store_pair(request, tmp_path):
+    """Two stores sharing one backend, as two workers would."""
+    if request.param == "sqlite":
+        db_path = str(tmp_path / "db.sqlite")
+        stores = [main.SQLiteTokenStore(db_path, poll_interval=0.02) for _ in range(2)]
+    else:
+        server = fakeredis.FakeServer()
+        stores = [
+            main.RedisTokenStore(fakeredis.FakeRedis(server=server, decode_responses=True))
+            for _ in range(2)
+        ]
+    yield stores
+    for store in stores:
+        store.close()
+
+
+@pytest.fixture
+def store(store_pair, monkeypatch):
+    monkeypatch.setattr(main, "token_store", store_pair[0])
+    main.clear_credentials_cache()
+    yield store_pair[0]
+    main.clear_credentials_cache()
+
+
+def test_incomplete_store_cannot_be_instantiated():
+    class Incomplete(main.TokenStore):
+        def get(self, email):
+            return None, 0
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_save_get_delete(store_pair):
+    a, b = store_pair
+    assert a.get("x@y.com") == (None, 0)
+    assert a.first_email() is None
+
+    assert a.save("x@y.com", "token-1") == 1
+    assert b.get("x@y.com") == ("token-1", 1)
+    assert b.first_email() == "x@y.com"
+
+    assert b.save("x@y.com", "token-2") == 2
+    assert a.get("x@y.com") == ("token-2", 2)
+
+    # The generation keeps counting across logout so stale reads are detectable
+    assert a.delete("x@y.com") == 3
+    assert b.get("x@y.com") == (None, 3)
+    assert b.generation("x@y.com") == 3
+    assert b.first_email() is None
+
+
+def test_invalidation_reaches_other_instances_only(store_pair):
+    a, b = store_pair
+    seen_a, seen_b = [], []
+    a.listen_invalidations(seen_a.append, lambda: None)
+    b.listen_invalidations(seen_b.append, lambda: None)
+    time.sleep(0.1)
+
+    a.publish_invalidation("x@y.com")
+
+    assert wait_for(lambda: seen_b == ["x@y.com"])
+    time.sleep(0.1)
+    assert seen_a == []
+
+
+def test_refresh_lock(store_pair):
+    a, b = store_pair
+    owner = a.acquire_refresh_lock("x@y.com", 30)
+    assert owner
+    assert b.acquire_refresh_lock("x@y.com", 30) is None
+
+    # Releasing with someone else's id leaves the lock alone
+    b.release_refresh_lock("x@y.com", "not-the-owner")
+    assert b.acquire_refresh_lock("x@y.com", 30) is None
+
+    a.release_refresh_lock("x@y.com", owner)
+    assert b.acquire_refresh_lock("x@y.com", 30)
+
+
+def test_expired_refresh_lock_can_be_taken_over(store_pair):
+    a, b = store_pair
+    assert a.acquire_refresh_lock("x@y.com", 0.05)
+    time.sleep(0.1)
+    assert b.acquire_refresh_lock("x@y.com", 30)
+
+
+def test_get_credentials_is_cached(store, monkeypatch):
+    store.save("x@y.com", make_token())
+    first = main.get_credentials("x@y.com")
+
+    monkeypatch.setattr(store, "get", lambda email: pytest.fail("cache miss"))
+    assert main.get_credentials("x@y.com") is first
+
+
+def test_logout_on_other_worker_evicts_cache(store, store_pair):
+    other = store_pair[1]
+    store.listen_invalidations(main.evict_cached_credentials, main.clear_credentials_cache)
+    time.sleep(0.1)
+    store.save("x@y.com", make_token())
+    assert main.get_credentials("x@y.com") is not None
+
+    other.delete("x@y.com")
+    other.publish_invalidation("x@y.com")
+
+    assert wait_for(lambda: "x@y.com" not in main._credentials_cache)
+    assert main.get_credentials("x@y.com") is None
+
+
+def test_logout_during_read_is_not_cached(store, store_pair, monkeypatch):
+    other = store_pair[1]
+    store.save("x@y.com", make_token())
+    original_get = store.get
+
+    def get_then_logout(email):
+        result = original_get(email)
+        # Another worker logs the user out after our read; its event reaches
+        # us before anything is cached, so the eviction has nothing to remove
+        other.delete(email)
+        other.publish_invalidation(email)
+        main.evict_cached_credentials(email)
+        return result
+
+    monkeypatch.setattr(store, "get", get_then_logout)
+    main.get_credentials("x@y.com")
+    assert "x@y.com" not in main._credentials_cache
+
+    monkeypatch.setattr(store, "get", original_get)
+    assert main.get_credentials("x@y.com") is None
+
+
+def test_cache_entries_expire_without_invalidation(store, monkeypatch):
+    monkeypatch.setattr(main, "CREDENTIALS_CACHE_TTL", 0.05)
+    store.save("x@y.com", make_token())
+    assert main.get_credentials("x@y.com") is not None
+
+    # Missed event: the token is gone but nobody told this worker
+    store.delete("x@y.com")
+    time.sleep(0.1)
+    assert main.get_credentials("x@y.com") is None
+
+
+def test_concurrent_refresh_happens_once(store, monkeypatch):
+    store.save("x@y.com", make_token(token="old", expires_in=-60))
+    refreshes = []
+
+    def fake_refresh(creds, request):
+        refreshes.append(creds.token)
+        time.sleep(0.1)
+        creds.token = "new"
+        creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    monkeypatch.setattr(Credentials, "refresh", fake_refresh)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(main.get_credentials("x@y.com").token))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert refreshes == ["old"]
+    assert results == ["new"] * 4
+    assert json.loads(store.get("x@y.com")[0])["token"] == "new"
+
+
+def test_lifespan_opens_store_and_logout_clears_token(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TOKEN_STORE_URL", f"sqlite:///{tmp_path / 'db.sqlite'}")
+    assert main.token_store is None
+
+    with TestClient(main.app) as client:
+        main.token_store.save("x@y.com", make_token())
+        assert client.get("/get_authenticated_user").json() == {"email": "x@y.com"}
+
+        response = client.post("/logout", data={"user_email": "x@y.com"})
+        assert response.status_code == 200
+        assert client.get("/get_authenticated_user").status_code == 404
+
+    assert main.token_store is None
+
+
+def test_redis_listener_flushes_cache_after_connection_error():
+    store = main.RedisTokenStore(fakeredis.FakeRedis(decode_responses=True))
+    resets = []
+    store.listen_invalidations(lambda email: None, lambda: resets.append(True))
+    pubsub = store._listener.pubsub
+    original_get_message = pubsub.get_message
+    calls = []
+
+    def drop_connection_once(*args, **kwargs):
+        if not calls:
+            calls.append(True)
+            raise ConnectionError("connection lost")
+        return original_get_message(*args, **kwargs)
+
+    pubsub.get_message = drop_connection_once
+    try:
+        assert wait_for(lambda: resets == [True])
+        # The listener thread survives the error and keeps running
+        assert store._listener.is_alive()
+    finally:
+        store.close()